@@ -1,12 +1,19 @@
-from flask import Flask, request, jsonify
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import orjson
+import redis
+from flask import Flask, Response, request
 from flask_cors import CORS
 from flasgger import Swagger 
+from sqlalchemy import case, select
 
 from model import Session
-from model.compensation import Compensation, SpeciesStatus
-from model.patch_compensation import PatchCompensation
-from model.app_compensation import AppCompensation
-from model.utils import load_compensacao_from_csv_once,load_patch_compensacao_from_csv_once,load_species_status_from_csv_once,load_app_compensacao_from_csv_once
+from model.compensation import SpeciesStatus
+from model.utils import load_all_from_csv_once,municipios_cached,APP_BY_MUNI,PATCH_BY_MUNI,compute_tree_totals,get_rule
 
 app = Flask(__name__)
 CORS(app)
@@ -25,12 +32,105 @@ STATUS_DESCRIPTIONS = {
 
 }
 
+# valores de texto aceitos como "sim" no campo endangered
+_TRUTHY = frozenset({"true", "1", "yes", "sim", "t", "y"})
+
+_BOOL_PARSERS = {
+    bool: lambda v: v,
+    str: lambda v: v.strip().lower() in _TRUTHY,
+    int: bool,
+    float: bool,
+}
+
+
+def _coerce_bool(value):
+    """Converts a JSON endangered flag to bool; unknown types count as False."""
+    parser = _BOOL_PARSERS.get(type(value))
+    return parser(value) if parser else False
+
+# cache-aside opcional para /api/species/status; sem REDIS_URL a rota vai direto ao banco
+SPECIES_CACHE_TTL = 3600
+SPECIES_LOCK_TTL = 5
+SPECIES_LOCK_WAIT = 0.05
+SPECIES_LOCK_RETRIES = 10
+SPECIES_YIELD_PER = 1000
+
+REDIS_URL = os.environ.get("REDIS_URL")
+redis_client = (
+    redis.Redis.from_url(REDIS_URL, socket_connect_timeout=0.2, socket_timeout=0.2)
+    if REDIS_URL
+    else None
+)
+
+
+def _species_cache_lookup(key):
+    """Returns (cached_body, owns_lock) for a species cache key.
+
+    On a miss, the first caller takes a short lock and rebuilds the entry;
+    the others wait briefly for it instead of all hitting the database.
+    Any Redis error is treated as a miss.
+    """
+    if redis_client is None:
+        return None, False
+    try:
+        cached = redis_client.get(key)
+        if cached is not None:
+            return cached, False
+        if redis_client.set(f"{key}:lock", 1, nx=True, ex=SPECIES_LOCK_TTL):
+            return None, True
+        for _ in range(SPECIES_LOCK_RETRIES):
+            time.sleep(SPECIES_LOCK_WAIT)
+            cached = redis_client.get(key)
+            if cached is not None:
+                return cached, False
+    except redis.RedisError:
+        pass
+    return None, False
+
+
+def _species_cache_store(key, body, owns_lock):
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(key, SPECIES_CACHE_TTL, body)
+        if owns_lock:
+            redis_client.delete(f"{key}:lock")
+    except redis.RedisError:
+        pass
+
+def ojsonify(obj):
+    try:
+        body = orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        # orjson só aceita inteiros de 64 bits; entradas do cliente ecoadas podem ser maiores
+        body = json.dumps(obj)
+    return Response(body, mimetype="application/json")
+
+def body_etag(body):
+    """Strong ETag derived from the bytes of an already-encoded response.
+
+    Same digest municipios_cached stores next to its cached bodies.
+    """
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def cached_json_response(body, etag, max_age=3600):
+    """Serves a pre-encoded JSON body with caching headers, or a 304 if the client has it."""
+    # If-None-Match usa comparação fraca (proxies podem enfraquecer o ETag, ex. gzip)
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={max_age}"
+    return resp
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    Session.remove()
+
 @app.before_first_request
 def init_compensation():
-    load_compensacao_from_csv_once()
-    load_patch_compensacao_from_csv_once()
-    load_species_status_from_csv_once()
-    load_app_compensacao_from_csv_once()
+    load_all_from_csv_once()
 
 @app.route('/')
 def home():
@@ -53,23 +153,14 @@ def home():
                 message:
                   type: string
     """
-    return jsonify({
+    return ojsonify({
         "status": "ok",
         "message": "Tree trade-off API is running"
     }), 200
 
 @app.route("/api/app_municipios", methods=["GET"])
 def listar_app_municipios():
-    session = Session()
-    rows = (
-        session.query(AppCompensation.municipality)
-        .distinct()
-        .order_by(AppCompensation.municipality)
-        .all()
-    )
-    municipios = [r[0] for r in rows if r[0]]
-    session.close()
-    return jsonify({"municipios": municipios}), 200
+    return cached_json_response(*municipios_cached("app"))
 
 
 
@@ -115,33 +206,33 @@ def get_species_status():
     """
     family = request.args.get("family", "").strip()
     specie = request.args.get("specie", "").strip()  
-    session = Session()
-    try:
-        q = session.query(SpeciesStatus)
 
-        if family:
-            
-            q = q.filter(SpeciesStatus.family.ilike(f"%{family}%"))
-        if specie:
-            
-            q = q.filter(SpeciesStatus.specie.ilike(f"%{specie}%"))
+    # ILIKE não diferencia maiúsculas, então a chave também não
+    cache_key = f"v1:species:{family.lower()}:{specie.lower()}"
+    cached, owns_lock = _species_cache_lookup(cache_key)
+    if cached is not None:
+        return cached_json_response(cached, body_etag(cached), SPECIES_CACHE_TTL)
 
-        rows = q.all()
+    session = Session()
+    stmt = select(
+        SpeciesStatus.family,
+        SpeciesStatus.specie,
+        SpeciesStatus.status,
+        case(STATUS_DESCRIPTIONS, value=SpeciesStatus.status, else_="").label("description"),
+    )
 
+    if family:
         
-        result = [
-            {
-                "family": row.family,
-                "specie": row.specie,  
-                "status": row.status,
-                "description": STATUS_DESCRIPTIONS.get(row.status, ""),
-            }
-            for row in rows
-        ]
+        stmt = stmt.where(SpeciesStatus.family.ilike(f"%{family}%"))
+    if specie:
+        
+        stmt = stmt.where(SpeciesStatus.specie.ilike(f"%{specie}%"))
 
-        return jsonify(result), 200
-    finally:
-        session.close()
+    # execution option yield_per liga server-side cursor + buffer de SPECIES_YIELD_PER linhas
+    rows = session.execute(stmt.execution_options(yield_per=SPECIES_YIELD_PER)).mappings()
+    body = orjson.dumps([dict(row) for row in rows])
+    _species_cache_store(cache_key, body, owns_lock)
+    return cached_json_response(body, body_etag(body), SPECIES_CACHE_TTL)
 
 
 @app.route('/api/municipios', methods=['GET'])
@@ -165,16 +256,7 @@ def listar_municipios():
                   items:
                     type: string
     """
-    session = Session()
-    rows = (
-        session.query(Compensation.municipality)
-        .distinct()
-        .order_by(Compensation.municipality)
-        .all()
-    )
-    municipios = [r[0] for r in rows if r[0]]
-    session.close()
-    return jsonify({"municipios": municipios}), 200
+    return cached_json_response(*municipios_cached("federal"))
 
 @app.route("/api/patch_municipios", methods=["GET"])
 def listar_patch_municipios():
@@ -197,16 +279,7 @@ def listar_patch_municipios():
                   items:
                     type: string
     """
-    session = Session()
-    rows = (
-        session.query(PatchCompensation.municipality)
-        .distinct()
-        .order_by(PatchCompensation.municipality)
-        .all()
-    )
-    municipios = [r[0] for r in rows if r[0]]
-    session.close()
-    return jsonify({"municipios": municipios}), 200
+    return cached_json_response(*municipios_cached("patch"))
 
 
 @app.route('/api/compensacao/lote', methods=['POST'])
@@ -254,11 +327,12 @@ def calcular_compensacao_lote():
 
     items = data.get("items")
     if not isinstance(items, list) or not items:
-        return jsonify({"error": "You need to send a list with at least one item"}), 400
+        return ojsonify({"error": "You need to send a list with at least one item"}), 400
 
-    session = Session()
     resultados = []
-    total_geral = 0
+    quantidades = []
+    bases = []
+    multipliers = []
     itens_sem_regra = []
 
     for idx, item in enumerate(items):
@@ -285,13 +359,7 @@ def calcular_compensacao_lote():
             })
             continue
 
-        query = session.query(Compensation).filter(
-            Compensation.municipality == municipality,
-        )
-        if group:
-            query = query.filter(Compensation.group == group)
-
-        regra = query.first()
+        regra = get_rule(municipality, group)
         if not regra:
             itens_sem_regra.append({
                 "index": idx,
@@ -303,22 +371,17 @@ def calcular_compensacao_lote():
             })
             continue
 
-        is_endangered = False
-        if isinstance(endangered_flag, bool):
-            is_endangered = endangered_flag
-        elif isinstance(endangered_flag, str):
-            is_endangered = endangered_flag.strip().lower() in ("true", "1", "yes", "sim")
+        is_endangered = _coerce_bool(endangered_flag)
 
-        base_comp = regra.compensation
+        base_comp, endangered_multiplier = regra
         multiplier = 1.0
         if is_endangered:
             
-            multiplier = regra.endangered or 1.0
-
-        comp_por_arvore = base_comp * multiplier
-        total_item = quantidade * comp_por_arvore
-        total_geral += total_item
+            multiplier = endangered_multiplier or 1.0
 
+        quantidades.append(quantidade)
+        bases.append(base_comp)
+        multipliers.append(multiplier)
         resultados.append({
             "municipality": municipality,
             "group": group,
@@ -326,13 +389,15 @@ def calcular_compensacao_lote():
             "endangered": is_endangered,
             "compensacao_base": base_comp,
             "multiplicador_endangered": multiplier,
-            "compensacao_por_arvore": comp_por_arvore,
-            "compensacao_total_item": total_item,
         })
 
-    session.close()
+    comp_por_arvore, totais, total_geral = compute_tree_totals(quantidades, bases, multipliers)
 
-    return jsonify({
+    for resultado, comp, total_item in zip(resultados, comp_por_arvore.tolist(), totais.tolist()):
+        resultado["compensacao_por_arvore"] = comp
+        resultado["compensacao_total_item"] = total_item
+
+    return ojsonify({
         "processed_items": resultados,
         "total_trade-off": total_geral,
         "items_without_trade-off": itens_sem_regra
@@ -373,16 +438,14 @@ def calcular_compensacao_patch():
         description: Patch trade-off
     """
     data = request.get_json() or {}
-    print("Received data for patch:", data)  
-
     patches = data.get("patches")
+    app.logger.debug("patch payload size=%d", len(patches) if isinstance(patches, list) else 0)
     if not isinstance(patches, list) or not patches:
-        return jsonify({"erro": "Send a list with at least one element"}), 400
-
-    session = Session()
+        return ojsonify({"erro": "Send a list with at least one element"}), 400
 
     resultados = []
-    total_geral = 0.0
+    areas = []
+    comps_por_m2 = []
     patches_sem_regra = []
 
     for idx, patch in enumerate(patches):
@@ -416,13 +479,9 @@ def calcular_compensacao_patch():
             continue
 
         
-        regra = (
-            session.query(PatchCompensation)
-            .filter(PatchCompensation.municipality == municipality)
-            .first()
-        )
+        comp_por_m2 = PATCH_BY_MUNI.get(municipality)
 
-        if not regra:
+        if comp_por_m2 is None:
             patches_sem_regra.append({
                 "index": idx,
                 "motivo": "não existe regra de compensação para este município",
@@ -431,20 +490,21 @@ def calcular_compensacao_patch():
             continue
 
         
-        comp_por_m2 = regra.compensation_m2
-        total_patch = comp_por_m2 * area_m2
-        total_geral += total_patch
-
+        areas.append(area_m2)
+        comps_por_m2.append(comp_por_m2)
         resultados.append({
             "municipality": municipality,
             "area_m2": area_m2,
             "compensacao_por_m2": comp_por_m2,
-            "compensacao_total_patch": total_patch,
         })
 
-    session.close()
+    totais = np.asarray(comps_por_m2, dtype=np.float64) * np.asarray(areas, dtype=np.float64)
+    total_geral = float(totais.sum())
 
-    return jsonify({
+    for resultado, total_patch in zip(resultados, totais.tolist()):
+        resultado["compensacao_total_patch"] = total_patch
+
+    return ojsonify({
         "patches_processados": resultados,
         "total_compensacao_geral": total_geral,
         "patches_sem_regra": patches_sem_regra,
@@ -486,11 +546,11 @@ def calcular_compensacao_app():
     apps = data.get("apps")
 
     if not isinstance(apps, list) or not apps:
-        return jsonify({"erro": "Send a list with at least one element"}), 400
+        return ojsonify({"erro": "Send a list with at least one element"}), 400
 
-    session = Session()
     resultados = []
-    total_geral = 0.0
+    quantidades = []
+    comps_por_unidade = []
     apps_sem_regra = []
 
     for idx, app_item in enumerate(apps):
@@ -521,13 +581,9 @@ def calcular_compensacao_app():
             })
             continue
 
-        regra = (
-            session.query(AppCompensation)
-            .filter(AppCompensation.municipality == municipality)
-            .first()
-        )
+        comp_por_unidade = APP_BY_MUNI.get(municipality)
 
-        if not regra:
+        if comp_por_unidade is None:
             apps_sem_regra.append({
                 "index": idx,
                 "motivo": "There is no trade-off PPA rule for this municipality",
@@ -535,20 +591,21 @@ def calcular_compensacao_app():
             })
             continue
 
-        comp_por_unidade = regra.compensation
-        total_app = comp_por_unidade * quantidade
-        total_geral += total_app
-
+        quantidades.append(quantidade)
+        comps_por_unidade.append(comp_por_unidade)
         resultados.append({
             "municipality": municipality,
             "quantidade": quantidade,
             "compensacao_por_unidade": comp_por_unidade,
-            "compensacao_total_app": total_app,
         })
 
-    session.close()
+    totais = np.asarray(comps_por_unidade, dtype=np.float64) * np.asarray(quantidades, dtype=np.float64)
+    total_geral = float(totais.sum())
+
+    for resultado, total_app in zip(resultados, totais.tolist()):
+        resultado["compensacao_total_app"] = total_app
 
-    return jsonify({
+    return ojsonify({
         "apps_processados": resultados,
         "total_compensacao_geral": total_geral,
         "apps_sem_regra": apps_sem_regra,
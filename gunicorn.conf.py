@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+# configuração do gunicorn: `gunicorn app:app` lê este arquivo automaticamente
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5002")
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+
+# workers gevent sobrepõem as esperas de I/O (banco, redis) dentro de um mesmo processo
+worker_class = "gevent"
+worker_connections = 100
+
+
+def on_starting(server):
+    # carrega os CSVs no banco uma única vez, antes do fork, para os workers não
+    # competirem inserindo nas tabelas vazias; cada worker depois só monta os
+    # índices em memória no init_compensation. Roda num subprocesso para o master
+    # nunca importar `model` (engine e scoped_session nasceriam antes do patch do
+    # gevent e seriam herdados pelos workers)
+    subprocess.run(
+        [sys.executable, "-c", "from model.utils import load_all_from_csv_once; load_all_from_csv_once()"],
+        cwd=server.cfg.chdir,
+        check=True,
+    )
+
+
+def post_fork(server, worker):
+    # roda no worker antes de o app ser importado; torna o psycopg2 cooperativo
+    # com o gevent, para as esperas no banco liberarem os outros greenlets
+    if os.environ.get("DATABASE_URL", "").startswith("postgresql"):
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
@@ -1,6 +1,12 @@
+import logging
+import os
+
+import greenlet
 from sqlalchemy_utils import database_exists, create_database
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
 
 # importando os elementos definidos no modelo
 from model.base import Base
@@ -8,16 +14,24 @@ from model.compensation import Compensation, SpeciesStatus
 from model.patch_compensation import PatchCompensation
 from model.app_compensation import AppCompensation
 
+logger = logging.getLogger(__name__)
+
+
 
+# url de acesso ao banco (por padrão o sqlite local; DATABASE_URL sobrescreve)
+db_url = os.environ.get("DATABASE_URL", 'sqlite:///database/db.sqlite3')
 
-# url de acesso ao banco (essa é uma url de acesso ao sqlite local)
-db_url = 'sqlite:///database/db.sqlite3'
+engine_options = {"echo": False, "pool_pre_ping": True}
+if make_url(db_url).get_backend_name() != "sqlite":
+    # o sqlite em arquivo usa NullPool, que não aceita pool_size/max_overflow
+    engine_options.update(pool_size=10, max_overflow=20)
 
 # cria a engine de conexão com o banco
-engine = create_engine(db_url, echo=False)
+engine = create_engine(db_url, **engine_options)
 
-# Instancia um criador de seção com o banco
-Session = sessionmaker(bind=engine)
+# Instancia um criador de seção com o banco, uma sessão por greenlet (cada thread
+# tem o seu greenlet principal, então também vale sem gevent)
+Session = scoped_session(sessionmaker(bind=engine), scopefunc=greenlet.getcurrent)
 
 # cria o banco se ele não existir 
 if not database_exists(engine.url):
@@ -25,3 +39,29 @@ if not database_exists(engine.url):
 
 # cria as tabelas do banco, caso não existam
 Base.metadata.create_all(engine)
+
+# create_all não altera tabelas existentes, então garante os índices
+# adicionados depois em bancos já criados
+for index in Compensation.__table__.indexes:
+    index.create(engine, checkfirst=True)
+
+# no postgres, índices trigram deixam os ILIKE '%...%' de species_status usarem índice;
+# são opcionais, então sem permissão para criar a extensão a API sobe sem eles
+if engine.dialect.name == "postgresql":
+    try:
+        with engine.begin() as conn:
+            has_trgm = conn.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            ).first()
+            if not has_trgm:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_species_family_trgm "
+                "ON species_status USING gin (family gin_trgm_ops)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_species_specie_trgm "
+                "ON species_status USING gin (specie gin_trgm_ops)"
+            ))
+    except DBAPIError as e:
+        logger.warning("Skipping pg_trgm species indexes: %s", e)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Float
+from sqlalchemy import Column, String, Integer, Float, Index
 from model import Base
 
 class Compensation(Base):
@@ -7,10 +7,14 @@ class Compensation(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     group = Column(String())  
     municipality = Column(String())    
-    compensation = Column(Integer)               
-    endangered = Column(Integer, default=1)
+    compensation = Column(Float)               
+    endangered = Column(Float, default=1.0)
 
-    def __init__(self, group: str, municipality:str,compensation:int, endangered:int):
+    __table_args__ = (
+        Index("ix_fedcomp_muni_group", "municipality", "group"),
+    )
+
+    def __init__(self, group: str, municipality:str,compensation:float, endangered:float):
         self.group = group 
         self.municipality = municipality 
         self.compensation = compensation
@@ -1,6 +1,15 @@
 import csv
+import hashlib
 import os
+from functools import lru_cache
 from pathlib import Path
+
+import numba
+import numpy as np
+import orjson
+from numba import njit, prange
+from sqlalchemy import insert, select
+
 from model import Session
 from model.compensation import Compensation, SpeciesStatus
 from model.patch_compensation import PatchCompensation
@@ -14,7 +23,143 @@ _STATUS_LOADED = False
 _app_loaded = False
 STATUS_CSV_PATH = BASE_DIR / "species_status.csv"
 APP_CSV = BASE_DIR / "app_compensation.csv"
-
+# lotes a partir deste tamanho usam o kernel numba em vez do numpy
+NUMBA_MIN_ITEMS = 1024
+# o servidor atende requisições em várias threads; a camada workqueue aborta o
+# processo se duas entram no kernel paralelo ao mesmo tempo, então exige tbb/omp
+numba.config.THREADING_LAYER = "threadsafe"
+
+MUNICIPIO_MODELS = {
+    "federal": Compensation,
+    "patch": PatchCompensation,
+    "app": AppCompensation,
+}
+
+
+@lru_cache(maxsize=4)
+def municipios_cached(model_name: str) -> tuple:
+    """Lista de municípios distintos de uma tabela, já serializada em JSON.
+
+    Retorna (body, digest), com o digest blake2b do body calculado uma vez
+    (o app usa como ETag). As tabelas só mudam quando os CSVs são
+    recarregados, então o resultado fica em cache no processo até o
+    próximo `cache_clear()`.
+    """
+    model = MUNICIPIO_MODELS[model_name]
+    session = Session()
+    stmt = select(model.municipality).distinct().order_by(model.municipality)
+    try:
+        rows = session.execute(stmt).scalars().all()
+    finally:
+        session.close()
+    municipios = [m for m in rows if m]
+    body = orjson.dumps({"municipios": municipios})
+    return body, hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+# regras de compensação em memória, preenchidas pelos load_* e lidas pelos POSTs:
+# _COMP_INDEX[municipio][grupo] -> (compensação base, multiplicador endangered)
+# PATCH_BY_MUNI / APP_BY_MUNI[municipio] -> compensação
+_COMP_INDEX = {}
+PATCH_BY_MUNI = {}
+APP_BY_MUNI = {}
+
+
+def _index_compensation(session):
+    index = {}
+    stmt = select(
+        Compensation.municipality,
+        Compensation.group,
+        Compensation.compensation,
+        Compensation.endangered,
+    ).order_by(Compensation.id)
+    for muni, group, comp, endangered in session.execute(stmt):
+        by_group = index.setdefault(muni, {})
+        by_group.setdefault(group, (comp, endangered))
+        # sem grupo informado vale a primeira regra do município
+        by_group.setdefault(None, (comp, endangered))
+    _COMP_INDEX.clear()
+    _COMP_INDEX.update(index)
+
+
+def _index_patch_compensation(session):
+    stmt = select(PatchCompensation.municipality, PatchCompensation.compensation_m2)
+    index = dict(session.execute(stmt).all())
+    PATCH_BY_MUNI.clear()
+    PATCH_BY_MUNI.update(index)
+
+
+def _index_app_compensation(session):
+    stmt = select(AppCompensation.municipality, AppCompensation.compensation)
+    index = dict(session.execute(stmt).all())
+    APP_BY_MUNI.clear()
+    APP_BY_MUNI.update(index)
+
+
+def get_rule(municipality, group=None):
+    """(compensação base, multiplicador endangered) para (município, grupo), ou None."""
+    by_group = _COMP_INDEX.get(municipality)
+    return by_group.get(group or None) if by_group else None
+
+
+def _read_csv(f, *columns):
+    """Abre o CSV com csv.reader e resolve pelo cabeçalho o índice de cada coluna.
+
+    Retorna (indices, rows). Linhas em branco são puladas, como no DictReader;
+    coluna ausente aponta para uma célula vazia, e linhas curtas são
+    completadas com "", então `row[i]` nunca falha.
+    """
+    reader = csv.reader(f)
+    header = next(reader, [])
+    indices = [header.index(c) if c in header else len(header) for c in columns]
+    width = max(indices) + 1
+
+    def rows():
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row.extend([""] * (width - len(row)))
+            yield row
+
+    return indices, rows()
+
+
+# assinatura explícita: compila (ou lê do cache) já no import, porque a primeira
+# compilação disparada por várias threads ao mesmo tempo trava o processo
+@njit(
+    "Tuple((float64[:], float64[:], float64))(float64[:], float64[:], float64[:])",
+    parallel=True,
+    fastmath=True,
+    cache=True,
+)
+def _reduce(qty, base, mult):
+    n = qty.shape[0]
+    por_arvore = np.empty(n)
+    totais = np.empty(n)
+    total = 0.0
+    for i in prange(n):
+        por_arvore[i] = base[i] * mult[i]
+        totais[i] = qty[i] * por_arvore[i]
+        total += totais[i]
+    return por_arvore, totais, total
+
+
+def compute_tree_totals(quantidades, bases, multipliers):
+    """Compensação por árvore, total por item e total geral de um lote.
+
+    Retorna (por_arvore, totais, total_geral); lotes grandes vão para o
+    kernel numba, os demais ficam no numpy.
+    """
+    qty = np.asarray(quantidades, dtype=np.float64)
+    base = np.asarray(bases, dtype=np.float64)
+    mult = np.asarray(multipliers, dtype=np.float64)
+    if qty.shape[0] >= NUMBA_MIN_ITEMS:
+        por_arvore, totais, total = _reduce(qty, base, mult)
+        return por_arvore, totais, float(total)
+    por_arvore = base * mult
+    totais = qty * por_arvore
+    return por_arvore, totais, float(totais.sum())
 
 
 def load_compensacao_from_csv_once(force: bool = False):
@@ -22,6 +167,7 @@ def load_compensacao_from_csv_once(force: bool = False):
 
     
     if not force and session.query(Compensation).first():
+        _index_compensation(session)
         session.close()
         return
 
@@ -36,15 +182,17 @@ def load_compensacao_from_csv_once(force: bool = False):
         session.commit()
 
     with csv_path.open(newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
+        (i_group, i_muni, i_comp, i_end), reader = _read_csv(
+            f, "group", "municipality", "compensation", "endangered"
+        )
         rows = []
         for row in reader:
-            group = row["group"].strip()
-            municipality = row["municipality"].strip()
-            comp = int(row["compensation"])
+            group = row[i_group].strip()
+            municipality = row[i_muni].strip()
+            comp = float(row[i_comp])
 
             
-            end_str = row.get("endangered", "").strip()
+            end_str = row[i_end].strip()
             if not end_str:
                 endangered = 1.0
             else:
@@ -53,20 +201,20 @@ def load_compensacao_from_csv_once(force: bool = False):
                 except ValueError:
                     endangered = 1.0   
 
-            rows.append(
-                Compensation(
-                    group=group,
-                    municipality=municipality,
-                    compensation=comp,
-                    endangered=endangered,
-                )
-            )
+            rows.append({
+                "group": group,
+                "municipality": municipality,
+                "compensation": comp,
+                "endangered": endangered,
+            })
 
     if rows:
-        session.add_all(rows)
+        session.execute(insert(Compensation.__table__), rows)
         session.commit()
+        municipios_cached.cache_clear()
         print("Compensation table loaded from CSV")
 
+    _index_compensation(session)
     session.close()
 
 
@@ -75,6 +223,7 @@ def load_patch_compensacao_from_csv_once():
     session = Session()
     count = session.query(PatchCompensation).count()
     if count > 0:
+        _index_patch_compensation(session)
         session.close()
         print("Patch compensation table already populated.")
         return
@@ -84,40 +233,31 @@ def load_patch_compensacao_from_csv_once():
         print(f"PATCH CSV not found at {PATCH_CSV}")
         return
 
-    rows = []
-    seen = set()
+    rows_by_muni = {}
 
     with PATCH_CSV.open(newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
+        (i_muni, i_comp_m2), reader = _read_csv(f, "municipality", "compensation_m2")
         for row in reader:
-            muni = (row.get("municipality") or "").strip()
+            muni = row[i_muni].strip()
             if not muni:
                 continue
-            if muni in seen:
-                
-                continue
-            seen.add(muni)
 
-            comp_m2_str = row.get("compensation_m2")
-            if comp_m2_str is None:
-                continue
+            comp_m2_str = row[i_comp_m2]
             try:
                 comp_m2 = float(comp_m2_str)
             except ValueError:
                 continue
 
-            rows.append(
-                PatchCompensation(
-                    municipality=muni,
-                    compensation_m2=comp_m2
-                )
-            )
+            # município repetido: vale a última linha, como numa constraint unique
+            rows_by_muni[muni] = {"municipality": muni, "compensation_m2": comp_m2}
 
-    if rows:
-        session.add_all(rows)
+    if rows_by_muni:
+        session.execute(insert(PatchCompensation.__table__), list(rows_by_muni.values()))
         session.commit()
+        municipios_cached.cache_clear()
         print("Patch compensation table loaded from CSV.")
 
+    _index_patch_compensation(session)
     session.close()
 
 def load_species_status_from_csv_once():
@@ -137,25 +277,24 @@ def load_species_status_from_csv_once():
             print(f"Species CSV not found at: {STATUS_CSV_PATH}")
             return
 
+        rows = []
         with STATUS_CSV_PATH.open(newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
+            (i_family, i_specie, i_species, i_status), reader = _read_csv(
+                f, "family", "specie", "species", "status"
+            )
 
             for raw_row in reader:
-                family = (raw_row.get("family") or "").strip()
-                specie = (raw_row.get("specie") or raw_row.get("species") or "").strip()
-                status = (raw_row.get("status") or "").strip()
+                family = raw_row[i_family].strip()
+                specie = (raw_row[i_specie] or raw_row[i_species]).strip()
+                status = raw_row[i_status].strip()
 
                 if not family or not specie or not status:
                     continue  
 
-                session.add(
-                    SpeciesStatus(
-                        family=family,
-                        specie=specie,
-                        status=status,
-                    )
-                )
+                rows.append({"family": family, "specie": specie, "status": status})
 
+        if rows:
+            session.execute(insert(SpeciesStatus.__table__), rows)
         session.commit()
         _STATUS_LOADED = True
         print("Species status table loaded from CSV.")
@@ -176,6 +315,7 @@ def load_app_compensacao_from_csv_once(force: bool = False):
     if not force:
         # já tem dados? não recarrega
         if session.query(AppCompensation).count() > 0:
+            _index_app_compensation(session)
             session.close()
             _app_loaded = True
             print("App compensation table already populated.")
@@ -190,38 +330,42 @@ def load_app_compensacao_from_csv_once(force: bool = False):
         session.query(AppCompensation).delete()
         session.commit()
 
-    rows = []
-    seen = set()
+    rows_by_muni = {}
 
     with APP_CSV.open(newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
+        (i_muni, i_comp), reader = _read_csv(f, "municipality", "compensation")
         for row in reader:
-            muni = (row.get("municipality") or "").strip()
+            muni = row[i_muni].strip()
             if not muni:
                 continue
-            if muni in seen:
-                continue
-            seen.add(muni)
 
-            comp_str = row.get("compensation")
-            if comp_str is None:
-                continue
+            comp_str = row[i_comp]
             try:
                 comp = float(comp_str)
             except ValueError:
                 continue
 
-            rows.append(
-                AppCompensation(
-                    municipality=muni,
-                    compensation=comp,
-                )
-            )
+            rows_by_muni[muni] = {"municipality": muni, "compensation": comp}
 
-    if rows:
-        session.add_all(rows)
+    if rows_by_muni:
+        session.execute(insert(AppCompensation.__table__), list(rows_by_muni.values()))
         session.commit()
+        municipios_cached.cache_clear()
         print("App compensation table loaded from CSV.")
 
+    _index_app_compensation(session)
     session.close()
     _app_loaded = True
+
+
+def load_all_from_csv_once():
+    """Popula as tabelas a partir dos CSVs (se vazias) e monta os índices em memória.
+
+    Com vários workers, o gunicorn chama isto uma vez no master antes do fork
+    (ver gunicorn.conf.py), então cada worker só encontra as tabelas prontas
+    e reconstrói os próprios índices.
+    """
+    load_compensacao_from_csv_once()
+    load_patch_compensacao_from_csv_once()
+    load_species_status_from_csv_once()
+    load_app_compensacao_from_csv_once()